@@ -1,10 +1,52 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict
+from fastapi.responses import StreamingResponse
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Union
+from collections import Counter
 from datetime import datetime
+import asyncio
+import functools
+import hashlib
+import json
+import logging
 import os
-import fitz  # PyMuPDF
-from openai import OpenAI
+import re
+import threading
+from cachetools import TTLCache
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Тяжелые модули (fitz, openai, numpy) импортируем при первом использовании:
+# воркер стартует быстрее, /healthz не тянет их вовсе
+@functools.lru_cache(maxsize=None)
+def _fitz():
+    import fitz  # PyMuPDF
+    return fitz
+
+
+@functools.lru_cache(maxsize=None)
+def _np():
+    import numpy
+    return numpy
+
+
+# Движок извлечения текста: pymupdf (по умолчанию) или pdfium — быстрее на больших
+# документах, когда раскладка страницы не важна. Без pypdfium2 остается fitz
+PDF_BACKEND = os.environ.get("BLOODWORK_PDF_BACKEND", "pymupdf").lower()
+
+
+@functools.lru_cache(maxsize=None)
+def _pdfium():
+    try:
+        import pypdfium2
+    except ImportError:
+        return None
+    return pypdfium2
+
 
 app = FastAPI()
 
@@ -16,83 +58,865 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Кэш ответов LLM. BLOODWORK_CACHE=exact (по умолчанию) — только точное совпадение текста,
+# semantic — плюс поиск похожих отчетов по эмбеддингам, off — без кэша
+CACHE_MODE = os.environ.get("BLOODWORK_CACHE", "exact").lower()
+SEMANTIC_THRESHOLD = 0.97
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MAX_CHARS = 8000
+
+_cache = TTLCache(maxsize=1000, ttl=3600)
+# TTLCache не потокобезопасен, а Streamlit гоняет каждую сессию в своем потоке
+_cache_lock = threading.Lock()
+# Семантический индекс: (нормированный эмбеддинг, ключ в _cache, числа из отчета)
+_semantic_index: List[tuple] = []
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def _cache_key(pdf_text: str) -> str:
+    return hashlib.sha256(_normalize(pdf_text).encode()).hexdigest()
+
+
+def _numbers(pdf_text: str) -> tuple:
+    return tuple(_NUMBER_RE.findall(pdf_text))
+
+
+def _semantic_lookup(embedding: "np.ndarray", pdf_text: str) -> Optional[List[dict]]:
+    if not _semantic_index:
+        return None
+    # Записи, у которых истек TTL в основном кэше, выкидываем из индекса
+    _semantic_index[:] = [entry for entry in _semantic_index if entry[1] in _cache]
+    if not _semantic_index:
+        return None
+    np = _np()
+    matrix = np.stack([entry[0] for entry in _semantic_index])
+    scores = matrix @ embedding
+    best = int(np.argmax(scores))
+    if scores[best] < SEMANTIC_THRESHOLD:
+        return None
+    # Серая зона: похожий по смыслу отчет с другими значениями — это другой анализ,
+    # поэтому попадание засчитываем только при совпадении всех чисел
+    _, key, numbers = _semantic_index[best]
+    if numbers != _numbers(pdf_text):
+        return None
+    return _cache.get(key)
+
+
+def _semantic_add(embedding: "np.ndarray", key: str, pdf_text: str) -> None:
+    _semantic_index.append((embedding, key, _numbers(pdf_text)))
+    if len(_semantic_index) > _cache.maxsize:
+        del _semantic_index[0]
+
+
+# Модель для извлечения. gpt-4o-mini с примерами должна быть быстрее и дешевле;
+# прежде чем менять умолчание, сравни модели на реальных PDF: eval_models.py
+MODEL = os.environ.get("BLOODWORK_MODEL", "gpt-4o")
+
+# Потолок на длину ответа: битый PDF не должен вызывать бесконечную генерацию.
+# 4096 с запасом покрывает JSON по одной части отчета (до CHUNK_TOKENS на входе);
+# у батча потолок растет с числом отчетов, но не выше лимита модели
+MAX_OUTPUT_TOKENS = int(os.environ.get("BLOODWORK_MAX_OUTPUT_TOKENS", "4096"))
+MAX_BATCH_OUTPUT_TOKENS = 16384
+_SAMPLING = {"temperature": 0, "top_p": 1, "frequency_penalty": 0, "presence_penalty": 0, "logprobs": False}
+
+_SYSTEM = "You are a medical transcription assistant. Extract lab results accurately and return them as JSON for Russian medical consultation notes."
+
+_RULES = """Return a JSON object of the form:
+{"groups": [{"test_type": "ОАК", "date": "17.07.2025", "items": [{"name": "эритроциты", "value": "4.8", "unit": "/л", "ref_low": "3.9", "ref_high": "4.7", "status": "выше нормы"}]}]}
+
+Rules:
+1. Keep original Russian test names and test group names
+2. Include every test with its value and unit exactly as printed
+3. ref_low and ref_high are the reference range bounds as printed; use null for a missing bound
+4. status is повышено/понижено/выше нормы/ниже нормы when indicated, otherwise null
+5. Group related tests together, one group per test type
+6. date is the test date as printed, or null when not available"""
+
+_FEW_SHOT_REPORT_1 = """ОБЩИЙ АНАЛИЗ КРОВИ
+Дата взятия биоматериала: 17.07.2025
+Исследование Результат Ед. изм. Референсные значения
+Лейкоциты 5.5 10^9/л 4.0 - 9.0
+Эритроциты 4.8 ↑ 10^12/л 3.9 - 4.7
+Гемоглобин 135 г/л 120 - 140
+СОЭ 25 ↑ мм/ч 2 - 15"""
+
+_FEW_SHOT_RESULT_1 = {"groups": [{"test_type": "ОАК", "date": "17.07.2025", "items": [
+    {"name": "лейкоциты", "value": "5.5", "unit": "10^9/л", "ref_low": "4.0", "ref_high": "9.0", "status": None},
+    {"name": "эритроциты", "value": "4.8", "unit": "10^12/л", "ref_low": "3.9", "ref_high": "4.7", "status": "выше нормы"},
+    {"name": "гемоглобин", "value": "135", "unit": "г/л", "ref_low": "120", "ref_high": "140", "status": None},
+    {"name": "СОЭ", "value": "25", "unit": "мм/ч", "ref_low": "2", "ref_high": "15", "status": "выше нормы"},
+]}]}
+
+_FEW_SHOT_REPORT_2 = """Биохимический анализ крови 03.02.2025
+Глюкоза
+4.9
+ммоль/л
+3.9-6.1
+Холестерин общий
+6.3
+ммоль/л
+< 5.2
+повышено
+Ферритин 12 нг/мл 13 - 150 понижено
+Гормоны 03.02.2025
+ТТГ 2.1 мкМЕ/мл 0.4-4.0"""
+
+_FEW_SHOT_RESULT_2 = {"groups": [
+    {"test_type": "Биохимический анализ крови", "date": "03.02.2025", "items": [
+        {"name": "глюкоза", "value": "4.9", "unit": "ммоль/л", "ref_low": "3.9", "ref_high": "6.1", "status": None},
+        {"name": "холестерин общий", "value": "6.3", "unit": "ммоль/л", "ref_low": None, "ref_high": "5.2", "status": "повышено"},
+        {"name": "ферритин", "value": "12", "unit": "нг/мл", "ref_low": "13", "ref_high": "150", "status": "понижено"},
+    ]},
+    {"test_type": "Гормоны", "date": "03.02.2025", "items": [
+        {"name": "ТТГ", "value": "2.1", "unit": "мкМЕ/мл", "ref_low": "0.4", "ref_high": "4.0", "status": None},
+    ]},
+]}
+
+
+# Промпты собираются один раз: префикс побайтно одинаковый во всех запросах
+# (никаких дат и id в начале), чтобы OpenAI мог закэшировать его на своей стороне
+_PROMPT_PREFIX = f"""Analyze this medical lab report and extract ALL test results.
+
+{_RULES}
+
+Medical lab report text:
+"""
+
+# Примеры идут перед реальным отчетом и тоже не меняются — входят в кэшируемый префикс
+_FEW_SHOT = [
+    {"role": "user", "content": _PROMPT_PREFIX + _FEW_SHOT_REPORT_1},
+    {"role": "assistant", "content": json.dumps(_FEW_SHOT_RESULT_1, ensure_ascii=False)},
+    {"role": "user", "content": _PROMPT_PREFIX + _FEW_SHOT_REPORT_2},
+    {"role": "assistant", "content": json.dumps(_FEW_SHOT_RESULT_2, ensure_ascii=False)},
+]
+
+_BATCH_PROMPT_PREFIX = f"""Process each of the following medical lab reports independently and extract ALL test results of each one.
+
+{_RULES}
+
+Wrap the per-report objects as {{"results": {{"<report id>": {{"groups": [...]}}}}}} with exactly one entry per <report> tag, keyed by its id attribute.
+
+Medical lab reports:
+"""
+
+
+def _format_reports(pdf_texts: List[str]) -> tuple:
+    ids = [f"r{i}" for i in range(len(pdf_texts))]
+    reports = "\n\n".join(
+        f'<report id="{report_id}">\n{pdf_text}\n</report>'
+        for report_id, pdf_text in zip(ids, pdf_texts)
+    )
+    return ids, reports
+
+
+# У батча свой пример: ответ обернут в {"results": ...}, а не голый {"groups": ...}
+_BATCH_FEW_SHOT = [
+    {"role": "user", "content": _BATCH_PROMPT_PREFIX + _format_reports([_FEW_SHOT_REPORT_1, _FEW_SHOT_REPORT_2])[1]},
+    {"role": "assistant", "content": json.dumps(
+        {"results": {"r0": _FEW_SHOT_RESULT_1, "r1": _FEW_SHOT_RESULT_2}}, ensure_ascii=False
+    )},
+]
+
+
+def _parse_groups(report: dict) -> List[dict]:
+    groups = report.get("groups") if isinstance(report, dict) else None
+    if not isinstance(groups, list):
+        raise ValueError("LLM response has no 'groups' list")
+    return groups
+
+
+def _format_item(item: dict) -> str:
+    low, high = item.get("ref_low"), item.get("ref_high")
+    if low is not None and high is not None:
+        ref = f"({low}-{high})"
+    elif high is not None:
+        ref = f"(<{high})"
+    elif low is not None:
+        ref = f"(>{low})"
+    else:
+        ref = None
+    parts = [item.get("name"), item.get("value"), item.get("unit"), ref, item.get("status")]
+    return " ".join(str(part) for part in parts if part)
+
+
+# Проверка ответа модели по исходному тексту: числа из отчета собираем одним
+# проходом общего регулярного выражения, значение анализа считается подтвержденным,
+# если все его числа встречаются в отчете (защита от выдуманных значений)
+_SCAN_RE = re.compile(r"(?P<number>\d+(?:[.,]\d+)?)|(?P<word>[A-Za-zА-Яа-яЁё]+)")
+
+
+def _validate(groups: List[dict], pdf_text: str) -> List[dict]:
+    numbers, words = set(), set()
+    for match in _SCAN_RE.finditer(pdf_text):
+        if match.lastgroup == "number":
+            numbers.add(match.group().replace(",", "."))
+        else:
+            words.add(match.group().lower())
+
+    for group in groups:
+        for item in group.get("items") or []:
+            value = str(item.get("value") or "")
+            tokens = list(_SCAN_RE.finditer(value))
+            item["verified"] = bool(tokens) and all(
+                match.group().replace(",", ".") in numbers
+                if match.lastgroup == "number"
+                else match.group().lower() in words
+                for match in tokens
+            )
+    return groups
+
+
+def format_results(groups: List[dict]) -> str:
+    """Собирает строку для консультации: группы через "; ", анализы через ", "."""
+    formatted = []
+    for group in groups:
+        title = group.get("test_type") or ""
+        if group.get("date"):
+            title = f"{title} от {group['date']}"
+        items = ", ".join(_format_item(item) for item in group.get("items") or [])
+        formatted.append(f"{title}: {items}" if title else items)
+    return "; ".join(formatted)
+
+
+# Предочистка текста перед отправкой в LLM: номера страниц, контакты лаборатории,
+# строки-разделители. Строки с названиями анализов не трогаем — в PDF-таблицах
+# название и значение часто оказываются на разных строках
+_PAGE_RE = re.compile(r"^(?:страница|стр\.|page)\s*\d+", re.I)
+_FOOTER_RE = re.compile(r"^(?:тел\.|телефон|факс|www\.|https?://|e-?mail|©)", re.I)
+# Разделитель — строка только из черточек/точек. Одиночные ↑ ↓ * ! оставляем:
+# это флаг выхода за норму из отдельной ячейки таблицы
+_SEPARATOR_RE = re.compile(r"^[-–—_=.·…\s]+$")
+_SPACES_RE = re.compile(r"[ \t\xa0]+")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def _clean(text: str) -> str:
+    lines = []
+    for line in _SPACES_RE.sub(" ", text).splitlines():
+        line = line.strip()
+        if line and (_PAGE_RE.match(line) or _FOOTER_RE.match(line) or _SEPARATOR_RE.match(line)):
+            continue
+        lines.append(line)
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+# Шаблоны крупных лабораторий печатаются стабильной таблицей
+# "Исследование Результат Ед. изм. Референсные значения" — такие отчеты разбираем
+# регулярками без LLM. Лабораторию узнаем по названию в исходном тексте
+_PROVIDER_SIGNATURES = {
+    "invitro": re.compile(r"ИНВИТРО|invitro", re.I),
+    "kdl": re.compile(r"\bКДЛ\b|\bKDL\b|kdl\.ru", re.I),
+    "helix": re.compile(r"ХЕЛИКС|helix", re.I),
+    "gemotest": re.compile(r"ГЕМОТЕСТ|gemotest", re.I),
+}
+_NUM = r"\d+(?:[.,]\d+)?"
+_ROW_RE = re.compile(
+    rf"^(?P<name>[A-Za-zА-Яа-яЁё][^\d\n]*?(?:\(\w+\))?)\s+"
+    rf"(?P<value>[<>]?\s?{_NUM})\s*(?P<flag>[↑↓]|[HL]\b)?\s+"
+    rf"(?P<unit>\S+)\s+"
+    rf"(?:(?P<ref_low>{_NUM})\s*[-–—]\s*(?P<ref_high>{_NUM})|<\s*(?P<ref_lt>{_NUM})|>\s*(?P<ref_gt>{_NUM}))\s*$"
+)
+_TABLE_HEADER_RE = re.compile(r"^(?:исследование|показатель|тест|наименование)\b", re.I)
+# Название группы анализов: строка без цифр с узнаваемым словом. Засчитываем его только
+# там, где группа и может начинаться: до первой строки таблицы или прямо перед
+# шапкой таблицы. Строка с качественным результатом группой не бывает
+_GROUP_HEADER_RE = re.compile(
+    r"^(?=\D*$).*(?:анализ|биохими|гормон|коагулограм|липид|электролит|витамин|иммун|онкомаркер|серолог)",
+    re.I,
+)
+_QUALITATIVE_RE = re.compile(r"(?:отрицат|положит|не\s+обнаруж|обнаруж|недостаточн|норма\b)", re.I)
+# Дата анализа — только из строки про взятие/исследование: первая дата в бланке
+# обычно дата рождения
+_SAMPLE_DATE_RE = re.compile(r"(?:взят\w*|дата\s+исследования)\D*?(\d{2}\.\d{2}\.\d{4})", re.I)
+_FLAG_STATUS = {"↑": "выше нормы", "H": "выше нормы", "↓": "ниже нормы", "L": "ниже нормы"}
+
+# Сколько отчетов разобрано шаблонами, а сколько ушло в LLM
+_template_hits: Counter = Counter()
+
+
+def _detect_provider(raw_text: str) -> Optional[str]:
+    # Название лаборатории бывает и в шапке, и в футере, поэтому смотрим оба края
+    edges = raw_text[:3000] + raw_text[-3000:]
+    for provider, signature in _PROVIDER_SIGNATURES.items():
+        if signature.search(edges):
+            return provider
+    return None
+
+
+def _row_status(value: str, low: Optional[str], high: Optional[str], flag: Optional[str]) -> Optional[str]:
+    if flag:
+        return _FLAG_STATUS[flag]
+    try:
+        number = float(value.lstrip("<> ").replace(",", "."))
+        if low is not None and number < float(low.replace(",", ".")):
+            return "ниже нормы"
+        if high is not None and number > float(high.replace(",", ".")):
+            return "выше нормы"
+    except ValueError:
+        pass
+    return None
+
+
+def _parse_known_template(raw_text: str, pdf_text: str) -> Optional[List[dict]]:
+    """Разбирает отчет известной лаборатории или возвращает None (тогда решает LLM).
+
+    Отвечаем без модели, только если поняли весь бланк: после шапки таблицы каждая
+    непустая строка — либо разобранный анализ, либо название группы. Любая другая
+    строка (анализ без норм, качественный результат, подпись врача) — в LLM.
+    """
+    provider = _detect_provider(raw_text)
+    if provider is None:
+        return None
+
+    date_match = _SAMPLE_DATE_RE.search(pdf_text)
+    date = date_match.group(1) if date_match else None
+    groups: List[dict] = []
+    title = None
+    in_table = False
+    rows_seen = False
+    lines = [line for line in pdf_text.splitlines() if line]
+    for i, line in enumerate(lines):
+        if _TABLE_HEADER_RE.match(line):
+            in_table = True
+            continue
+        next_is_header = i + 1 < len(lines) and _TABLE_HEADER_RE.match(lines[i + 1])
+        if (
+            _GROUP_HEADER_RE.match(line)
+            and not _QUALITATIVE_RE.search(line)
+            and (not rows_seen or next_is_header)
+        ):
+            title = line
+            continue
+        match = _ROW_RE.match(line)
+        if match is None:
+            # До шапки таблицы — данные пациента и направления, их не разбираем
+            if in_table:
+                return None
+            continue
+        if not in_table:
+            return None
+        rows_seen = True
+        low = match.group("ref_low") or match.group("ref_gt")
+        high = match.group("ref_high") or match.group("ref_lt")
+        if not groups or groups[-1]["test_type"] != title:
+            groups.append({"test_type": title, "date": date, "items": []})
+        groups[-1]["items"].append({
+            "name": match.group("name").strip(),
+            "value": match.group("value").replace(" ", ""),
+            "unit": match.group("unit"),
+            "ref_low": low,
+            "ref_high": high,
+            "status": _row_status(match.group("value"), low, high, match.group("flag")),
+        })
+
+    if not groups:
+        return None
+    _template_hits[provider] += 1
+    return groups
+
+
+# Ограничение размера промпта: текст длиннее MAX_PROMPT_TOKENS режется по строкам
+# на части до CHUNK_TOKENS токенов, каждая часть идет отдельным запросом
+MAX_PROMPT_TOKENS = 12000
+CHUNK_TOKENS = 10000
+
+
+@functools.lru_cache(maxsize=None)
+def _encoder():
+    # При первом вызове tiktoken качает словарь по сети. Если не вышло (нет сети или
+    # самого tiktoken), возвращаем None и дальше считаем по байтам UTF-8. None тоже
+    # кэшируется, так что загрузку заново не пробуем. Без сети словарь можно заранее
+    # положить в каталог TIKTOKEN_CACHE_DIR
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        logger.warning("tiktoken unavailable, estimating tokens by UTF-8 length", exc_info=True)
+        return None
+
+
+def _split(pdf_text: str) -> List[tuple]:
+    """Возвращает части текста вместе с числом токенов в каждой.
+
+    Токен BPE не короче байта, поэтому длина в байтах UTF-8 — оценка сверху:
+    короткий текст не режем. Без словаря tiktoken число токенов и есть эта оценка.
+    Синхронная: при первом вызове tiktoken загружает словарь (возможно, по сети),
+    поэтому из event loop ее зовем через _split_in_executor.
+    """
+    size = len(pdf_text.encode())
+    enc = _encoder()
+    if size <= MAX_PROMPT_TOKENS:
+        return [(pdf_text, len(enc.encode_ordinary(pdf_text)) if enc else size)]
+
+    lines = pdf_text.splitlines(keepends=True)
+    if enc:
+        sizes = [len(tokens) for tokens in enc.encode_ordinary_batch(lines)]
+    else:
+        sizes = [len(line.encode()) for line in lines]
+    total = sum(sizes)
+    if total <= MAX_PROMPT_TOKENS:
+        return [(pdf_text, total)]
+
+    chunks, current, current_size = [], [], 0
+    for line, line_size in zip(lines, sizes):
+        if current and current_size + line_size > CHUNK_TOKENS:
+            chunks.append(("".join(current), current_size))
+            current, current_size = [], 0
+        if line_size > CHUNK_TOKENS:
+            chunks.extend(_split_line(line, enc))
+            continue
+        current.append(line)
+        current_size += line_size
+    if current:
+        chunks.append(("".join(current), current_size))
+    return chunks
+
+
+def _split_line(line: str, enc) -> List[tuple]:
+    # Строку длиннее CHUNK_TOKENS режем по границам токенов, а без словаря — по
+    # символам: символ UTF-8 не длиннее 4 байт, так что кусок влезает в CHUNK_TOKENS
+    if enc:
+        tokens = enc.encode_ordinary(line)
+        return [
+            (enc.decode(tokens[i:i + CHUNK_TOKENS]), len(tokens[i:i + CHUNK_TOKENS]))
+            for i in range(0, len(tokens), CHUNK_TOKENS)
+        ]
+    step = CHUNK_TOKENS // 4
+    return [(line[i:i + step], len(line[i:i + step].encode())) for i in range(0, len(line), step)]
+
+
+async def _split_in_executor(pdf_text: str) -> List[tuple]:
+    return await asyncio.get_running_loop().run_in_executor(None, _split, pdf_text)
+
+
+def _merge_groups(groups: List[dict]) -> List[dict]:
+    # Группа, разрезанная границей частей, приходит дважды подряд — склеиваем
+    merged = []
+    for group in groups:
+        previous = merged[-1] if merged else None
+        if previous and (previous.get("test_type"), previous.get("date")) == (group.get("test_type"), group.get("date")):
+            previous["items"] = (previous.get("items") or []) + (group.get("items") or [])
+        else:
+            merged.append(group)
+    return merged
+
+
+# Разбор PDF уходит из event loop в отдельный поток. Ни PyMuPDF, ни pdfium не
+# поддерживают работу из нескольких потоков (даже с разными документами), а GIL они
+# не отпускают, так что параллельность ничего не дала бы: поток один, а прямые вызовы
+# из других потоков (Streamlit, скрипты) ждут на _PDF_LOCK
+_PDF_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf")
+_PDF_LOCK = threading.Lock()
+
+
+# Задачи обработки PDF, которые сейчас в работе, по (event loop, sha256 содержимого).
+# Задача привязана к своему loop: в Streamlit у каждой сессии свой asyncio.run
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+
 # Класс, как в твоем Streamlit-коде
 class BloodworkExtractor:
-    def __init__(self, openai_api_key: str):
-        self.client = OpenAI(api_key=openai_api_key)
-
-    def extract_text_from_pdf(self, pdf_path: str) -> str:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
-
-    def extract_bloodwork_results(self, pdf_text: str) -> str:
-        prompt = f"""
-        Analyze this medical lab report and extract ALL test results in the format used in Russian medical consultation notes.
-
-        Format each result as: "Test name: value unit (reference range) status"
-        Group by test type and include the test date.
-
-        Example format:
-        "ОАК от 17.07.2025: лейкоциты 5.5 /л (4-9), эритроциты 4.8 /л (3.9-4.7) выше нормы, гемоглобин 135 г/л (120-140)"
-
-        Rules:
-        1. Keep original Russian test names
-        2. Include all numerical values with units
-        3. Include reference ranges in parentheses
-        4. Add status (повышено/понижено/выше нормы/ниже нормы) when indicated
-        5. Group related tests together
-        6. Use commas to separate individual tests
-        7. Use semicolons to separate different test groups
-        8. Include test dates when available
-
-        Medical lab report text:
-        {pdf_text}
-        """
+    def __init__(self, openai_api_key: str, model: str = MODEL):
+        import httpx
+        from openai import AsyncOpenAI
+
+        self.model = model
+        # Один клиент на все запросы: пул соединений с api.openai.com переиспользуется
+        self.client = AsyncOpenAI(
+            api_key=openai_api_key,
+            max_retries=2,
+            timeout=60.0,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=100)),
+        )
+
+    async def close(self):
+        await self.client.close()
+
+    def extract_text_from_pdf(self, pdf: Union[str, bytes, bytearray]) -> str:
+        # Принимаем путь к файлу или содержимое PDF в памяти
+        with _PDF_LOCK:
+            if PDF_BACKEND == "pdfium" and _pdfium() is not None:
+                return self._extract_text_pdfium(pdf)
+            fitz = _fitz()
+            doc = fitz.open(pdf) if isinstance(pdf, str) else fitz.open(stream=pdf, filetype="pdf")
+            with doc:
+                return "".join(page.get_text("text") for page in doc)
+
+    def _extract_text_pdfium(self, pdf: Union[str, bytes, bytearray]) -> str:
+        pdfium = _pdfium()
+        doc = pdfium.PdfDocument(pdf if isinstance(pdf, (str, bytes)) else bytes(pdf))
+        try:
+            text = "\n".join(page.get_textpage().get_text_range() for page in doc)
+        finally:
+            doc.close()
+        # pdfium отдает переводы строк как \r\n, а fitz — \n; приводим к виду fitz,
+        # чтобы raw_text, кэш и разбор шаблонов не зависели от движка
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    async def extract_bloodwork_results(self, pdf_text: str) -> List[dict]:
+        raw_text, pdf_text = pdf_text, _clean(pdf_text)
+        groups = _parse_known_template(raw_text, pdf_text)
+        if groups is not None:
+            return _validate(groups, pdf_text)
+
+        key, embedding, cached = await self._cache_lookup(pdf_text)
+        if cached is not None:
+            return cached
+
+        _template_hits["llm"] += 1
+        result = _validate(await self._complete(pdf_text), pdf_text)
+        self._cache_store(key, embedding, pdf_text, result)
+        return result
+
+    async def _cache_lookup(self, pdf_text: str) -> tuple:
+        key = _cache_key(pdf_text)
+        if CACHE_MODE == "off":
+            return key, None, None
+        with _cache_lock:
+            cached = _cache.get(key)
+        if cached is not None:
+            return key, None, cached
+
+        embedding = None
+        if CACHE_MODE == "semantic":
+            # Семантический кэш необязателен: если эмбеддинг не получился, это просто промах
+            try:
+                embedding = await self._embed(pdf_text)
+            except Exception:
+                logger.warning("Embedding request failed, skipping semantic cache", exc_info=True)
+            else:
+                with _cache_lock:
+                    cached = _semantic_lookup(embedding, pdf_text)
+        return key, embedding, cached
+
+    def _cache_store(self, key: str, embedding: Optional["np.ndarray"], pdf_text: str, result: List[dict]):
+        if CACHE_MODE == "off":
+            return
+        with _cache_lock:
+            _cache[key] = result
+            if embedding is not None:
+                _semantic_add(embedding, key, pdf_text)
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
+    async def _embed(self, pdf_text: str) -> "np.ndarray":
+        response = await self.client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=_normalize(pdf_text)[:EMBEDDING_MAX_CHARS],
+        )
+        np = _np()
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    async def _complete(self, pdf_text: str, chunks: Optional[List[tuple]] = None) -> List[dict]:
+        if chunks is None:
+            chunks = await _split_in_executor(pdf_text)
+        if len(chunks) == 1:
+            return await self._complete_chunk(pdf_text, chunks[0][1])
+        # Большой отчет: части идут отдельными запросами в обход батчера (иначе батчер
+        # снова склеил бы их в один огромный промпт), параллельно; группы склеиваются по порядку
+        parts = await asyncio.gather(*(self._complete_one(chunk) for chunk, _ in chunks))
+        return _merge_groups([group for part in parts for group in part])
+
+    async def _complete_chunk(self, pdf_text: str, tokens: int) -> List[dict]:
+        # Если запущен батчер — встаем в очередь и ждем общий запрос
+        if _batch_queue is not None:
+            fut = asyncio.get_running_loop().create_future()
+            await _batch_queue.put((pdf_text, tokens, fut))
+            return await fut
+        return await self._complete_one(pdf_text)
+
+    async def _complete_one(self, pdf_text: str) -> List[dict]:
+        response = await self._create_one(pdf_text)
+        if response.choices[0].finish_reason == "length":
+            raise ValueError("LLM response was cut off at max_tokens")
+        return _parse_groups(json.loads(response.choices[0].message.content))
+
+    async def _create_one(self, pdf_text: str, stream: bool = False):
+        return await self.client.chat.completions.create(
+            model=self.model,
             messages=[
-                {
-                    "role": "system",
-                    "content": "You are a medical transcription assistant. Extract lab results accurately and format them for Russian medical consultation notes.",
-                },
-                {"role": "user", "content": prompt},
+                {"role": "system", "content": _SYSTEM},
+                *_FEW_SHOT,
+                {"role": "user", "content": _PROMPT_PREFIX + pdf_text},
             ],
-            temperature=0.1,
+            response_format={"type": "json_object"},
+            stream=stream,
+            **_SAMPLING,
+            max_tokens=MAX_OUTPUT_TOKENS,
         )
 
-        return response.choices[0].message.content.strip()
+    async def _complete_many(self, pdf_texts: List[str]) -> Dict[str, List[dict]]:
+        ids, reports = _format_reports(pdf_texts)
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": _SYSTEM},
+                *_BATCH_FEW_SHOT,
+                {"role": "user", "content": _BATCH_PROMPT_PREFIX + reports},
+            ],
+            response_format={"type": "json_object"},
+            **_SAMPLING,
+            max_tokens=min(MAX_OUTPUT_TOKENS * len(pdf_texts), MAX_BATCH_OUTPUT_TOKENS),
+        )
+        if response.choices[0].finish_reason == "length":
+            # Обрезанный JSON не разобрать — _run_batch переспросит каждый отчет отдельно
+            return {}
+
+        # Ответ не в той форме (не JSON, results — список) — считаем, что пропущены
+        # все отчеты: _run_batch переспросит каждый отдельно
+        try:
+            parsed = json.loads(response.choices[0].message.content).get("results")
+        except (json.JSONDecodeError, AttributeError):
+            return {}
+        if not isinstance(parsed, dict):
+            return {}
+        results = {}
+        for report_id in ids:
+            try:
+                results[report_id] = _parse_groups(parsed.get(report_id))
+            except ValueError:
+                # Битый или пропущенный отчет _run_batch доберет одиночным запросом
+                continue
+        return results
+
+    async def process_lab_report(self, pdf: Union[str, bytes, bytearray]) -> Dict[str, Any]:
+        # Одинаковые PDF, которые обрабатываются одновременно, делят одну задачу:
+        # N дублей — один вызов LLM. Задачу ждем через shield, чтобы отмена одного
+        # запроса (клиент отвалился) не отменяла работу для остальных
+        digest = hashlib.sha256(pdf.encode() if isinstance(pdf, str) else pdf).hexdigest()
+        key = (asyncio.get_running_loop(), digest)
+        task = _inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._process_lab_report(pdf))
+            _inflight[key] = task
+            task.add_done_callback(lambda _: _inflight.pop(key, None))
+        return await asyncio.shield(task)
 
-    def process_lab_report(self, pdf_path: str) -> Dict[str, str]:
-        pdf_text = self.extract_text_from_pdf(pdf_path)
-        formatted_results = self.extract_bloodwork_results(pdf_text)
+    async def _process_lab_report(self, pdf: Union[str, bytes, bytearray]) -> Dict[str, Any]:
+        # fitz синхронный — выносим в пул, чтобы не блокировать event loop
+        loop = asyncio.get_running_loop()
+        pdf_text = await loop.run_in_executor(_PDF_EXECUTOR, self.extract_text_from_pdf, pdf)
+        groups = await self.extract_bloodwork_results(pdf_text)
         return {
             "raw_text": pdf_text,
-            "formatted_results": formatted_results,
+            "formatted_results": format_results(groups),
+            "groups": groups,
             "processed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         }
 
-@app.post("/process_pdf/")
-async def process_pdf(file: UploadFile = File(...)):
+    async def stream_lab_report(self, pdf: Union[str, bytes, bytearray]) -> AsyncIterator[Dict[str, Any]]:
+        """Как process_lab_report, но отдает ответ модели по кусочкам.
+
+        События: meta (время обработки), delta (очередной фрагмент JSON от модели)
+        и в конце result с тем же содержимым, что у process_lab_report.
+        Батчер здесь не используется — общий запрос нельзя стримить по отчетам.
+        """
+        yield {"type": "meta", "processed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+        loop = asyncio.get_running_loop()
+        raw_text = await loop.run_in_executor(_PDF_EXECUTOR, self.extract_text_from_pdf, pdf)
+        pdf_text = _clean(raw_text)
+        groups = _parse_known_template(raw_text, pdf_text)
+        if groups is not None:
+            groups = _validate(groups, pdf_text)
+        else:
+            key, embedding, groups = await self._cache_lookup(pdf_text)
+            if groups is None:
+                _template_hits["llm"] += 1
+
+        if groups is None:
+            chunks = await _split_in_executor(pdf_text)
+            if len(chunks) > 1:
+                # Отчет не влезает в один запрос — стримить нечего, отдаем сразу результат
+                groups = await self._complete(pdf_text, chunks)
+            else:
+                response = await self._create_one(pdf_text, stream=True)
+                content = []
+                async for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    if chunk.choices[0].finish_reason == "length":
+                        raise ValueError("LLM response was cut off at max_tokens")
+                    delta = chunk.choices[0].delta.content or ""
+                    if delta:
+                        content.append(delta)
+                        yield {"type": "delta", "content": delta}
+                groups = _parse_groups(json.loads("".join(content)))
+            groups = _validate(groups, pdf_text)
+            self._cache_store(key, embedding, pdf_text, groups)
+
+        yield {
+            "type": "result",
+            "raw_text": raw_text,
+            "formatted_results": format_results(groups),
+            "groups": groups,
+        }
+
+
+# Микробатчинг: копим отчеты в очереди и отправляем одним запросом,
+# когда набралось MAX_BATCH штук, прошло MAX_WAIT_MS с первого или следующий
+# отчет вывел бы суммарный текст батча за MAX_PROMPT_TOKENS
+MAX_BATCH = int(os.environ.get("BLOODWORK_MAX_BATCH", "8"))
+MAX_WAIT_MS = int(os.environ.get("BLOODWORK_MAX_WAIT_MS", "150"))
+
+_batch_queue: Optional[asyncio.Queue] = None
+_batch_tasks: set = set()
+
+
+async def _batcher(extractor: BloodworkExtractor):
+    loop = asyncio.get_running_loop()
+    # Отчет, который не влез в бюджет токенов текущего батча, открывает следующий
+    carry = None
+    while True:
+        batch = [carry or await _batch_queue.get()]
+        carry = None
+        tokens = batch[0][1]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_batch_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if tokens + item[1] > MAX_PROMPT_TOKENS:
+                carry = item
+                break
+            batch.append(item)
+            tokens += item[1]
+        # Запрос к OpenAI идет отдельной задачей, чтобы сразу копить следующий батч
+        task = asyncio.create_task(_run_batch(extractor, batch))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
+
+
+async def _run_batch(extractor: BloodworkExtractor, batch: list):
+    try:
+        if len(batch) == 1:
+            results = {"r0": await extractor._complete_one(batch[0][0])}
+        else:
+            results = await extractor._complete_many([pdf_text for pdf_text, _, _ in batch])
+    except Exception as e:
+        for _, _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+
+    missing = []
+    for i, (pdf_text, _, fut) in enumerate(batch):
+        if fut.done():
+            continue
+        result = results.get(f"r{i}")
+        if result is None:
+            missing.append((pdf_text, fut))
+        else:
+            fut.set_result(result)
+
+    # Модель пропустила отчеты — добираем их одиночными запросами параллельно;
+    # ошибка повтора достается только своему отчету
+    retries = await asyncio.gather(
+        *(extractor._complete_one(pdf_text) for pdf_text, _ in missing), return_exceptions=True
+    )
+    for (_, fut), result in zip(missing, retries):
+        if fut.done():
+            continue
+        if isinstance(result, BaseException):
+            fut.set_exception(result)
+        else:
+            fut.set_result(result)
+
+
+def _get_extractor() -> Optional[BloodworkExtractor]:
+    # Экстрактор (и вместе с ним openai) создается при первом запросе к /process_pdf/
+    # и дальше переиспользуется всеми запросами
+    global _batch_queue
+    extractor = getattr(app.state, "extractor", None)
+    if extractor is not None:
+        return extractor
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
+        return None
+    extractor = app.state.extractor = BloodworkExtractor(api_key)
+    # Словарь tiktoken грузим заранее в фоне, а не в первом запросе. _encoder не
+    # бросает исключений, так что результат future можно не читать
+    asyncio.get_running_loop().run_in_executor(None, _encoder)
+    if MAX_BATCH > 1:
+        _batch_queue = asyncio.Queue()
+        task = asyncio.create_task(_batcher(extractor))
+        _batch_tasks.add(task)
+    return extractor
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    global _batch_queue
+    _batch_queue = None
+    for task in list(_batch_tasks):
+        task.cancel()
+    extractor = getattr(app.state, "extractor", None)
+    if extractor is not None:
+        await extractor.close()
+
+
+# Загрузку читаем кусками по 1 МБ в один растущий буфер: на большом PDF нет второй
+# полной копии в памяти, а слишком большой файл отсекается до разбора
+UPLOAD_CHUNK_BYTES = 1 << 20
+MAX_UPLOAD_BYTES = int(os.environ.get("BLOODWORK_MAX_UPLOAD_MB", "50")) << 20
+
+
+async def _read_upload(file: UploadFile) -> bytearray:
+    data = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+        data += chunk
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="PDF is too large")
+    return data
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "template_hits": dict(_template_hits)}
+
+
+@app.post("/process_pdf/")
+async def process_pdf(file: UploadFile = File(...)):
+    extractor = _get_extractor()
+    if extractor is None:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY not set in environment")
 
-    # Сохраняем файл временно
-    file_path = f"temp_{file.filename}"
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
+    # PDF разбираем прямо из памяти, без временного файла
+    data = await _read_upload(file)
 
     try:
-        extractor = BloodworkExtractor(api_key)
-        results = extractor.process_lab_report(file_path)
+        results = await extractor.process_lab_report(data)
         return results
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+
+
+@app.post("/process_pdf/stream/")
+async def process_pdf_stream(file: UploadFile = File(...)):
+    extractor = _get_extractor()
+    if extractor is None:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY not set in environment")
+
+    data = await _read_upload(file)
+
+    # Server-Sent Events: первые байты уходят клиенту сразу, не дожидаясь всего ответа
+    async def events():
+        try:
+            async for event in extractor.stream_lab_report(data):
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'detail': str(e)}, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
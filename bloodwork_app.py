@@ -0,0 +1,78 @@
+import asyncio
+import os
+import streamlit as st
+
+from api import BloodworkExtractor
+
+st.set_page_config(page_title="Bloodwork", page_icon="🩸")
+st.title("Расшифровка анализов")
+
+api_key = os.environ.get("OPENAI_API_KEY") or st.text_input("OpenAI API key", type="password")
+
+
+# Сколько отчетов одновременно отправляем в OpenAI — чтобы не упираться в rate limit
+MAX_CONCURRENCY = 8
+
+
+class PartialFailure(Exception):
+    """Часть файлов не обработалась; results — ответы и исключения по порядку файлов."""
+
+    def __init__(self, results: list):
+        super().__init__("some reports failed")
+        self.results = results
+
+
+async def _process(files_bytes: tuple, api_key: str) -> list:
+    # Клиент OpenAI привязан к event loop, а asyncio.run каждый раз создает новый.
+    # Один клиент на все файлы: общий пул соединений
+    extractor = BloodworkExtractor(api_key)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def process_one(file_bytes: bytes):
+        async with semaphore:
+            return await extractor.process_lab_report(file_bytes)
+
+    try:
+        return await asyncio.gather(
+            *(process_one(file_bytes) for file_bytes in files_bytes), return_exceptions=True
+        )
+    finally:
+        await extractor.close()
+
+
+# PDF обрабатываем в памяти, без временных файлов, все файлы параллельно. Кэш по
+# file_id и ключу API: повторное нажатие и перерисовка страницы не вызывают LLM
+# заново. Байты не хэшируем (префикс "_"). При ошибке функция бросает исключение,
+# и st.cache_data ничего не запоминает — повтор снова идет в API, а удачные отчеты
+# вернет кэш в api.py
+@st.cache_data(show_spinner=False)
+def _extract(_files_bytes: tuple, file_ids: tuple, api_key: str) -> list:
+    results = asyncio.run(_process(_files_bytes, api_key))
+    if any(isinstance(result, Exception) for result in results):
+        raise PartialFailure(results)
+    return results
+
+
+uploaded_files = st.file_uploader(
+    "Загрузите PDF с результатами анализов", type="pdf", accept_multiple_files=True
+)
+
+if uploaded_files and st.button("Обработать", disabled=not api_key):
+    try:
+        with st.spinner("Извлекаем результаты..."):
+            all_results = _extract(
+                tuple(f.getvalue() for f in uploaded_files),
+                tuple(f.file_id for f in uploaded_files),
+                api_key,
+            )
+    except PartialFailure as e:
+        all_results = e.results
+
+    for uploaded_file, results in zip(uploaded_files, all_results):
+        with st.expander(uploaded_file.name, expanded=len(uploaded_files) == 1):
+            if isinstance(results, Exception):
+                st.error(f"Ошибка при обработке: {results}")
+                continue
+            st.text_area("Для консультации", results["formatted_results"], height=200, key=uploaded_file.file_id)
+            st.caption(f"Обработано: {results['processed_at']}")
+            st.text(results["raw_text"])
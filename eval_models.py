@@ -0,0 +1,78 @@
+"""Сравнение моделей извлечения на папке с PDF.
+
+Запуск: python eval_models.py reports/ --baseline gpt-4o --candidate gpt-4o-mini
+
+Для каждого PDF обе модели извлекают результаты (без кэша и без разбора шаблонов),
+затем анализы сравниваются по паре (название, значение). Печатается доля анализов
+эталонной модели, которые кандидат извлек так же, и время ответа каждой модели.
+Код возврата 1, если общая доля совпадений ниже --min-agreement.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+from api import BloodworkExtractor, _clean
+
+
+def _items(groups: list) -> set:
+    return {
+        (str(item.get("name") or "").strip().lower(), str(item.get("value") or "").replace(",", ".").strip())
+        for group in groups
+        for item in group.get("items") or []
+    }
+
+
+async def _run(extractor: BloodworkExtractor, pdf_text: str) -> tuple:
+    started = time.monotonic()
+    groups = await extractor._complete(pdf_text)
+    return _items(groups), time.monotonic() - started
+
+
+async def main(args) -> int:
+    api_key = os.environ["OPENAI_API_KEY"]
+    baseline = BloodworkExtractor(api_key, model=args.baseline)
+    candidate = BloodworkExtractor(api_key, model=args.candidate)
+    pdfs = sorted(Path(args.directory).glob("*.pdf"))
+    if not pdfs:
+        print(f"No PDFs in {args.directory}", file=sys.stderr)
+        return 2
+
+    matched = total = 0
+    baseline_time = candidate_time = 0.0
+    try:
+        for pdf in pdfs:
+            pdf_text = _clean(baseline.extract_text_from_pdf(str(pdf)))
+            (expected, t_base), (actual, t_cand) = await asyncio.gather(
+                _run(baseline, pdf_text), _run(candidate, pdf_text)
+            )
+            common = len(expected & actual)
+            matched += common
+            total += len(expected)
+            baseline_time += t_base
+            candidate_time += t_cand
+            print(
+                f"{pdf.name}: {common}/{len(expected)} совпало, лишних {len(actual - expected)}, "
+                f"{args.baseline} {t_base:.1f} с, {args.candidate} {t_cand:.1f} с"
+            )
+    finally:
+        await baseline.close()
+        await candidate.close()
+
+    agreement = matched / total if total else 1.0
+    print(
+        f"Итого: {agreement:.1%} совпадений ({matched}/{total}), "
+        f"{args.baseline} {baseline_time:.1f} с, {args.candidate} {candidate_time:.1f} с"
+    )
+    return 0 if agreement >= args.min_agreement else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="папка с PDF для сравнения")
+    parser.add_argument("--baseline", default="gpt-4o")
+    parser.add_argument("--candidate", default="gpt-4o-mini")
+    parser.add_argument("--min-agreement", type=float, default=0.95)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,246 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import api
+
+HEADER = """ИНВИТРО
+Пациент: Иванова А. А.
+Дата рождения: 01.02.1980
+Дата взятия биоматериала: 17.07.2025
+"""
+
+TABLE = """Общий анализ крови
+Исследование Результат Единицы Референсные значения
+Лейкоциты 5.5 10^9/л 4.0 - 9.0
+Эритроциты 4.8 ↑ 10^12/л 3.9 - 4.7
+Гемоглобин 150 г/л 120 - 140
+Биохимический анализ крови
+Исследование Результат Единицы Референсные значения
+Холестерин общий 4.1 ммоль/л < 5.2
+"""
+
+
+def _parse(raw_text):
+    return api._parse_known_template(raw_text, api._clean(raw_text))
+
+
+def test_parses_known_template():
+    groups = _parse(HEADER + TABLE + "www.invitro.ru\n")
+
+    assert [group["test_type"] for group in groups] == ["Общий анализ крови", "Биохимический анализ крови"]
+    assert all(group["date"] == "17.07.2025" for group in groups)
+    blood = groups[0]["items"]
+    assert [item["name"] for item in blood] == ["Лейкоциты", "Эритроциты", "Гемоглобин"]
+    assert blood[0] == {
+        "name": "Лейкоциты", "value": "5.5", "unit": "10^9/л",
+        "ref_low": "4.0", "ref_high": "9.0", "status": None,
+    }
+    # Статус из стрелки и из сравнения с нормой
+    assert blood[1]["status"] == "выше нормы"
+    assert blood[2]["status"] == "выше нормы"
+    cholesterol = groups[1]["items"][0]
+    assert (cholesterol["ref_low"], cholesterol["ref_high"], cholesterol["status"]) == (None, "5.2", None)
+
+
+def test_date_of_birth_is_not_the_sample_date():
+    raw_text = "ИНВИТРО\nДата рождения: 01.02.1980\n" + TABLE
+    assert all(group["date"] is None for group in _parse(raw_text))
+
+
+def test_unknown_provider_goes_to_llm():
+    assert _parse(HEADER.replace("ИНВИТРО", "Лаборатория №1") + TABLE) is None
+
+
+def test_row_without_reference_range_goes_to_llm():
+    assert _parse(HEADER + TABLE + "Глюкоза 5.2 ммоль/л\n") is None
+    assert _parse(HEADER + TABLE + "Группа крови A(II)\n") is None
+
+
+def test_qualitative_row_goes_to_llm():
+    assert _parse(HEADER + TABLE + "ВИЧ отрицательно\n") is None
+
+
+def test_signature_after_table_goes_to_llm():
+    assert _parse(HEADER + TABLE + "Врач: Петрова\n") is None
+
+
+def test_cells_on_separate_lines_go_to_llm():
+    raw_text = HEADER + "Исследование Результат Единицы Референсные значения\nЭритроциты\n4.8\n↑\n10^12/л\n3.9 - 4.7\n"
+    assert _parse(raw_text) is None
+
+
+
+def test_group_title_between_rows_goes_to_llm():
+    # Группа без своей шапки таблицы после уже разобранных строк — шаблон не наш
+    raw_text = HEADER + TABLE + "Коагулограмма\nФибриноген 3.1 г/л 2 - 4\n"
+    assert _parse(raw_text) is None
+    lines = TABLE.splitlines()
+    raw_text = HEADER + "\n".join(lines[:3] + ["Витамин C недостаточность анализ"] + lines[3:]) + "\n"
+    assert _parse(raw_text) is None
+
+
+def test_qualitative_analysis_line_goes_to_llm():
+    assert _parse(HEADER + TABLE + "Серологический анализ на сифилис отрицательно\n") is None
+    assert _parse(HEADER + TABLE + "Анализ кала на скрытую кровь отрицательно\n") is None
+    # И до первой строки таблицы, где название группы иначе допустимо
+    lines = TABLE.splitlines()
+    raw_text = HEADER + "\n".join(lines[:2] + ["Анализ кала на скрытую кровь отрицательно"] + lines[2:]) + "\n"
+    assert _parse(raw_text) is None
+
+
+def test_clean_keeps_flag_cells_and_drops_separators():
+    raw_text = "Эритроциты\n4.8\n↑\n10^12/л\n----------\nГемоглобин\n150\n*\n. . . . .\nСтраница 1 из 2\nwww.invitro.ru\n"
+    assert api._clean(raw_text).splitlines() == ["Эритроциты", "4.8", "↑", "10^12/л", "Гемоглобин", "150", "*"]
+
+
+class _StubCompletions:
+    def __init__(self, contents):
+        self.contents = list(contents)
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        content = self.contents.pop(0)
+        if isinstance(content, Exception):
+            raise content
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")])
+
+
+def _extractor(*contents):
+    extractor = object.__new__(api.BloodworkExtractor)
+    extractor.model = "stub"
+    extractor.client = SimpleNamespace(chat=SimpleNamespace(completions=_StubCompletions(contents)))
+    return extractor
+
+
+def _groups(name):
+    return {"groups": [{"test_type": name, "date": None, "items": []}]}
+
+
+def _batch(loop, texts):
+    return [(text, 1, loop.create_future()) for text in texts]
+
+
+def test_malformed_batch_reply_falls_back_to_single_requests():
+    async def run():
+        loop = asyncio.get_running_loop()
+        for reply in ('{"results": [{"id": "r0"}]}', "not json"):
+            extractor = _extractor(reply, *(json.dumps(_groups(text)) for text in "abc"))
+            batch = _batch(loop, "abc")
+            await api._run_batch(extractor, batch)
+            assert [fut.result()[0]["test_type"] for _, _, fut in batch] == ["a", "b", "c"]
+            assert extractor.client.chat.completions.calls == 4
+
+    asyncio.run(run())
+
+
+def test_missing_batch_ids_are_retried_one_by_one():
+    async def run():
+        reply = json.dumps({"results": {"r1": _groups("b")}})
+        extractor = _extractor(reply, json.dumps(_groups("a")), RuntimeError("rate limit"))
+        batch = _batch(asyncio.get_running_loop(), "abc")
+        await api._run_batch(extractor, batch)
+        # Повтор каждого пропущенного отчета — отдельный запрос; ошибка повтора
+        # достается только своему отчету
+        assert batch[0][2].result()[0]["test_type"] == "a"
+        assert batch[1][2].result()[0]["test_type"] == "b"
+        assert isinstance(batch[2][2].exception(), RuntimeError)
+        assert extractor.client.chat.completions.calls == 3
+
+    asyncio.run(run())
+
+
+def test_batcher_carries_over_report_past_token_budget(monkeypatch):
+    async def run():
+        monkeypatch.setattr(api, "_batch_queue", asyncio.Queue())
+        batch_reply = json.dumps({"results": {"r0": _groups("b"), "r1": _groups("c")}})
+        extractor = _extractor(json.dumps(_groups("a")), batch_reply)
+        batcher = asyncio.create_task(api._batcher(extractor))
+        loop = asyncio.get_running_loop()
+        # a и b вместе не влезают в бюджет: a уходит один, b открывает следующий батч
+        sizes = {"a": api.MAX_PROMPT_TOKENS - 10, "b": 20, "c": 20}
+        items = [(text, tokens, loop.create_future()) for text, tokens in sizes.items()]
+        for item in items:
+            await api._batch_queue.put(item)
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(fut for _, _, fut in items)), 5)
+        finally:
+            batcher.cancel()
+        assert [groups[0]["test_type"] for groups in results] == ["a", "b", "c"]
+        assert extractor.client.chat.completions.calls == 2
+
+    asyncio.run(run())
+
+
+class _CharEncoder:
+    # Один символ — один токен: границы частей легко проверить
+    def encode_ordinary(self, text):
+        return list(text)
+
+    def encode_ordinary_batch(self, texts):
+        return [list(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+def test_short_text_is_not_split(monkeypatch):
+    monkeypatch.setattr(api, "_encoder", lambda: None)
+    assert api._split("Гемоглобин 150\n") == [("Гемоглобин 150\n", len("Гемоглобин 150\n".encode()))]
+
+
+def test_long_text_is_split_by_lines(monkeypatch):
+    monkeypatch.setattr(api, "MAX_PROMPT_TOKENS", 20)
+    monkeypatch.setattr(api, "CHUNK_TOKENS", 10)
+    text = "abcd\n" * 5 + "x" * 25 + "\nefg\n"
+    for encoder, size in ((_CharEncoder(), len), (None, lambda chunk: len(chunk.encode()))):
+        monkeypatch.setattr(api, "_encoder", lambda: encoder)
+        chunks = api._split(text)
+        assert "".join(chunk for chunk, _ in chunks) == text
+        assert all(tokens == size(chunk) <= 10 for chunk, tokens in chunks)
+    # Без словаря длинная строка режется по символам, и кириллица тоже влезает
+    chunks = api._split("ж" * 25)
+    assert "".join(chunk for chunk, _ in chunks) == "ж" * 25
+    assert all(tokens <= 10 for _, tokens in chunks)
+
+
+def test_merge_groups_joins_only_adjacent_parts():
+    def group(test_type, *names, date="17.07.2025"):
+        return {"test_type": test_type, "date": date, "items": [{"name": name} for name in names]}
+
+    merged = api._merge_groups([
+        group("ОАК", "Лейкоциты"), group("ОАК", "Эритроциты"),
+        group("ОАК", "СОЭ", date="18.07.2025"), group("Биохимия", "Глюкоза"), group("ОАК", "Гемоглобин"),
+    ])
+    assert [(g["test_type"], [item["name"] for item in g["items"]]) for g in merged] == [
+        ("ОАК", ["Лейкоциты", "Эритроциты"]), ("ОАК", ["СОЭ"]), ("Биохимия", ["Глюкоза"]), ("ОАК", ["Гемоглобин"]),
+    ]
+
+
+def test_cancelled_duplicate_does_not_cancel_shared_work():
+    async def run():
+        extractor = _extractor()
+        release, calls = asyncio.Event(), []
+
+        async def process(pdf):
+            calls.append(pdf)
+            await release.wait()
+            return {"raw_text": "ok"}
+
+        extractor._process_lab_report = process
+        first = asyncio.create_task(extractor.process_lab_report(b"%PDF"))
+        second = asyncio.create_task(extractor.process_lab_report(b"%PDF"))
+        await asyncio.sleep(0)
+        # Клиент первого запроса отвалился — второй все равно получает результат
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == {"raw_text": "ok"}
+        assert first.cancelled()
+        assert calls == [b"%PDF"]
+        await asyncio.sleep(0)
+        assert not api._inflight
+
+    asyncio.run(run())